@@ -1,13 +1,19 @@
 # === Импорты ===
 import os
 import logging
+import logging.handlers
+import atexit
+import queue
 import asyncio
 import sqlite3
 import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 
-from fastapi import FastAPI, Request, UploadFile
+from fastapi import BackgroundTasks, FastAPI, Request, UploadFile
+from fastapi.responses import ORJSONResponse
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, ReplyKeyboardMarkup, BotCommand
 from aiogram.fsm.storage.memory import MemoryStorage
@@ -15,13 +21,31 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
-from openai import AsyncOpenAI
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
+import httpx
+from aiolimiter import AsyncLimiter
+import aiosqlite
+from PIL import Image
+from cachetools import LRUCache, TTLCache
 
 from io import BytesIO
 import base64
+import json
+import orjson
 
 # === Настройка логирования ===
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# Обработчики только кладут записи в очередь, а вывод выполняет отдельный поток QueueListener,
+# поэтому запись логов не блокирует event loop
+log_queue = queue.SimpleQueue()
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, _log_output, respect_handler_level=True)
+_log_enqueue = logging.handlers.QueueHandler(log_queue)
+_log_enqueue.setFormatter(logging.Formatter('%(message)s')) # Итоговое форматирование — в _log_output
+logging.basicConfig(level=logging.INFO, handlers=[_log_enqueue])
+log_listener.start()
+atexit.register(log_listener.stop) # Дописываем оставшиеся записи при завершении процесса
 logger = logging.getLogger(__name__)
 
 # === Настройка окружения ===
@@ -35,6 +59,8 @@ CHANNEL_ID = os.getenv("CHANNEL_ID") # ID канала для уведомлен
 # Указываем относительный путь к директории с изображениями
 # Убедитесь, что папка 'img' находится в том же каталоге, что и main.py
 IMG_DIR = "img" 
+# file_id уже загруженных в Telegram картинок (имя файла -> file_id), чтобы не загружать их повторно
+IMG_FILE_IDS: Dict[str, str] = {}
 
 # Проверяем, существуют ли необходимые переменные окружения
 if not BOT_TOKEN:
@@ -49,60 +75,254 @@ if not CHANNEL_ID:
     CHANNEL_ID = None 
 
 # === Инициализация бота ===
-session = AiohttpSession()
+class TunedAiohttpSession(AiohttpSession):
+    """Сессия aiogram с настроенным пулом соединений aiohttp (лимит соединений, кэш DNS, keep-alive)."""
+
+    def __init__(self, limit: int = 100, ttl_dns_cache: int = 300, keepalive_timeout: float = 75, **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(limit=limit, ttl_dns_cache=ttl_dns_cache, keepalive_timeout=keepalive_timeout)
+
+session = TunedAiohttpSession()
 bot = Bot(token=BOT_TOKEN, session=session)
 dp = Dispatcher(storage=MemoryStorage())
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse) # Ответы сериализуются через orjson
 
-# Инициализация OpenAI клиента с увеличенным таймаутом (например, 60 секунд)
-# Значение по умолчанию может быть 10 секунд, что часто недостаточно для больших изображений
-openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=60.0) 
+# Общий HTTP-клиент для OpenAI: HTTP/2 мультиплексирует запросы в одно соединение,
+# а прогретые keep-alive соединения избавляют от повторного TLS-рукопожатия.
+openai_http = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    timeout=httpx.Timeout(60.0, connect=5.0), # 60 секунд на ответ — большие изображения обрабатываются долго
+    http2=True,
+)
+
+# Инициализация OpenAI клиента поверх общего HTTP-клиента.
+# Повторы SDK отключены: ими управляют воркеры очереди фото (см. analyze_photo).
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, http_client=openai_http)
 
 # === База данных ===
-# Подключаемся к базе данных SQLite. check_same_thread=False нужен для работы с FastAPI.
-conn = sqlite3.connect("users.db", check_same_thread=False)
-cursor = conn.cursor()
+# Работаем с SQLite асинхронно через aiosqlite, чтобы запросы не блокировали event loop.
+# WAL-режим позволяет читателям работать параллельно с писателем, поэтому держим
+# одно соединение на запись и несколько соединений на чтение.
+DB_PATH = "users.db"
+DB_READERS = 4 # Количество соединений для чтения
+DB_PAGE_CACHE_KB = -20000 # Кэш страниц SQLite (отрицательное значение — размер в КиБ, т.е. ~20 МБ)
 FREE_USES_LIMIT = 10 # Лимит бесплатных использований для новых пользователей
 
-def init_db():
-    """Инициализирует базу данных, создавая таблицу users, если она не существует."""
+# === SQL-запросы ===
+# Все запросы вынесены в константы: sqlite3 кэширует подготовленные запросы по тексту SQL,
+# поэтому один и тот же текст разбирается только один раз на соединение
+# (стандартного кэша на 128 запросов с запасом хватает для всех запросов ниже).
+SQL_UPSERT_USER = """
+    INSERT INTO users (user_id, last_active)
+    VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET last_active=excluded.last_active
+"""
+SQL_GET_USES = "SELECT uses_left FROM users WHERE user_id = ?"
+# RETURNING не используется: он появился только в SQLite 3.35, а в образе python:3.9-slim-buster — 3.27.
+# Новые значения читаются отдельным SELECT в том же блоке pool.write(), что под блокировкой писателя так же атомарно.
+SQL_CONSUME_USE = "UPDATE users SET uses_left = uses_left - 1 WHERE user_id = ? AND uses_left > 0"
+SQL_TOGGLE_ECONOMY = "UPDATE users SET economy = 1 - economy WHERE user_id = ?"
+SQL_REFUND_USE = "UPDATE users SET uses_left = uses_left + 1 WHERE user_id = ?"
+SQL_GET_USE_STATE = "SELECT uses_left, economy FROM users WHERE user_id = ?"
+SQL_ACTIVATE = "UPDATE users SET uses_left = 999 WHERE user_id = ?"
+SQL_USER_TOTALS = "SELECT COUNT(*), SUM(uses_left) FROM users"
+SQL_COUNT_USED = "SELECT COUNT(*) FROM users WHERE uses_left < ?"
+SQL_LAST_USERS = "SELECT user_id, uses_left, last_active FROM users ORDER BY last_active DESC LIMIT 20"
+SQL_USER_IDS_PAGE = "SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+SQL_ADD_BATCH_JOB = """
+    INSERT INTO batch_jobs (custom_id, batch_id, user_id, chat_id, message_id, username)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+SQL_PENDING_BATCHES = "SELECT DISTINCT batch_id FROM batch_jobs"
+SQL_BATCH_JOBS = "SELECT custom_id, user_id, chat_id, message_id, username FROM batch_jobs WHERE batch_id = ?"
+SQL_DELETE_BATCH_JOB = "DELETE FROM batch_jobs WHERE custom_id = ?"
+
+# === Кэши ===
+USES_CACHE: LRUCache = LRUCache(maxsize=10000) # user_id -> uses_left для недавно активных пользователей
+STATS_CACHE_TTL = 5 # Сколько секунд кэшировать статистику для админ-команд
+STATS_CACHE: TTLCache = TTLCache(maxsize=4, ttl=STATS_CACHE_TTL)
+
+# === Запись активности пользователей ===
+ACTIVITY_FLUSH_INTERVAL = 0.5 # Как часто (в секундах) записывать накопленные обновления last_active
+ACTIVITY_BATCH_SIZE = 500 # Сколько обновлений накопить до внеочередной записи
+known_users: Set[int] = set() # Пользователи, которые точно есть в БД (добавлены в этом процессе)
+pending_activity: Dict[int, str] = {} # user_id -> время последней активности, еще не записанное в БД
+activity_event: Optional[asyncio.Event] = None
+activity_task: Optional[asyncio.Task] = None
+
+# === Настройки рассылки ===
+BROADCAST_CONCURRENCY = 25 # Максимум одновременно отправляемых сообщений
+BROADCAST_RATE = 30 # Глобальный лимит Telegram: ~30 сообщений в секунду
+BROADCAST_RETRIES = 3 # Количество попыток отправки одному пользователю
+BROADCAST_BATCH = 500 # Сколько ID пользователей читать из БД за один запрос
+
+# === Настройки обработки фото ===
+PHOTO_WORKERS = 8 # Количество воркеров, разбирающих очередь фото
+OPENAI_CONCURRENCY = 8 # Максимум одновременных запросов к OpenAI
+OPENAI_RETRIES = 3 # Количество попыток запроса к OpenAI при ошибках соединения, лимитов и 5xx
+PHOTO_DRAIN_TIMEOUT = 15 # Сколько секунд при остановке ждать, пока воркеры разберут очередь фото
+RESTART_TEXT = "⚠️ Бот перезапускается, фото не обработано. Использование возвращено — отправьте фото ещё раз."
+IMAGE_MAX_SIDE = 1024 # Максимальный размер длинной стороны фото перед отправкой в OpenAI
+IMAGE_QUALITY = 80 # Качество JPEG при пережатии фото
+IMAGE_DETAIL = "low" # Детализация анализа: "low" — одна плитка 512x512 (~85 токенов), "high" — дороже в разы
+
+# === Настройки эконом-режима (OpenAI Batch API) ===
+BATCH_MAX_SIZE = 50 # Сколько фото набирать в один пакет
+BATCH_FLUSH_INTERVAL = 120 # Как часто (в секундах) отправлять накопленный пакет и проверять готовые
+BATCH_API_RETRIES = 3 # Повторы SDK для запросов к Batch API (у основного клиента они отключены)
+BATCH_RECORD_RETRIES = 3 # Попытки записать отправленный пакет в БД
+
+class DBPool:
+    """
+    Небольшой пул соединений aiosqlite: одно соединение на запись и N на чтение.
+    Каждое соединение в любой момент используется только одной задачей, поэтому
+    конкурентные обработчики не делят между собой курсоры и результаты fetchone().
+    """
+
+    def __init__(self, path: str, readers: int = DB_READERS):
+        self.path = path
+        self.readers_count = readers
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock: Optional[asyncio.Lock] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._free_readers: Optional[asyncio.Queue] = None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        """Открывает соединение и настраивает WAL-режим."""
+        db = await aiosqlite.connect(self.path)
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA busy_timeout=5000")
+        await db.execute(f"PRAGMA cache_size={DB_PAGE_CACHE_KB}")
+        return db
+
+    async def open(self):
+        """Открывает соединение на запись и соединения на чтение."""
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        # Примитивы asyncio создаются внутри работающего event loop (важно для Python 3.9)
+        self._write_lock = asyncio.Lock()
+        self._free_readers = asyncio.Queue()
+        for _ in range(self.readers_count):
+            db = await self._connect()
+            self._readers.append(db)
+            self._free_readers.put_nowait(db)
+
+    async def close(self):
+        """Закрывает все соединения пула."""
+        for db in self._readers:
+            await db.close()
+        self._readers.clear()
+        self._free_readers = None
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Выдает свободное соединение для чтения и возвращает его в пул после использования."""
+        if self._free_readers is None:
+            raise RuntimeError("Пул соединений с БД не открыт (init_db не вызван).")
+        db = await self._free_readers.get()
+        try:
+            yield db
+        finally:
+            self._free_readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def write(self):
+        """Выдает единственное соединение на запись. Коммит выполняется при выходе из блока."""
+        if self._writer is None:
+            raise RuntimeError("Пул соединений с БД не открыт (init_db не вызван).")
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                # В том числе CancelledError: иначе незавершенная транзакция осталась бы открытой
+                # и была бы закоммичена следующим писателем
+                await asyncio.shield(self._writer.rollback())
+                raise
+
+pool = DBPool(DB_PATH)
+
+async def init_db():
+    """Открывает пул соединений и создает таблицу users, если она не существует."""
     try:
-        cursor.execute(f"""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                uses_left INTEGER DEFAULT {FREE_USES_LIMIT},
-                last_active TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
+        await pool.open()
+        async with pool.write() as db:
+            await db.execute(f"""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    uses_left INTEGER DEFAULT {FREE_USES_LIMIT},
+                    last_active TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Индексы для статистики (uses_left < ?) и списка последних пользователей (ORDER BY last_active DESC)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_users_uses_left ON users(uses_left)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active DESC)")
+            # Колонка эконом-режима добавлена позже — добавляем ее в уже существующие базы
+            async with db.execute("PRAGMA table_info(users)") as cur:
+                columns = [row[1] for row in await cur.fetchall()]
+            if "economy" not in columns:
+                await db.execute("ALTER TABLE users ADD COLUMN economy INTEGER DEFAULT 0")
+            # Фото, отправленные в OpenAI Batch API и ожидающие результата
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS batch_jobs (
+                    custom_id TEXT PRIMARY KEY,
+                    batch_id TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    username TEXT
+                )
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_batch_id ON batch_jobs(batch_id)")
         logger.info("База данных успешно инициализирована.")
     except sqlite3.Error as e:
-        logger.error(f"Ошибка инициализации базы данных: {e}")
+        logger.error("Ошибка инициализации базы данных: %s", e)
+
+# Список команд бота создается один раз при импорте модуля
+BOT_COMMANDS = [
+    BotCommand(command="start", description="Запустить бота"),
+    BotCommand(command="menu", description="Открыть меню"),
+    BotCommand(command="profile", description="Показать профиль"),
+    BotCommand(command="buy", description="Оплатить подписку"),
+    BotCommand(command="admin", description="Админ-панель"),
+    BotCommand(command="broadcast", description="Рассылка от администратора"),
+    BotCommand(command="iqtest", description="Пройти IQ Тест"),
+    BotCommand(command="economy", description="Эконом-режим (ответ позже)")
+]
 
 async def setup_bot_commands():
     """Устанавливает стандартные команды бота, которые будут отображаться в меню Telegram."""
     try:
-        await bot.set_my_commands([
-            BotCommand(command="start", description="Запустить бота"),
-            BotCommand(command="menu", description="Открыть меню"),
-            BotCommand(command="profile", description="Показать профиль"),
-            BotCommand(command="buy", description="Оплатить подписку"),
-            BotCommand(command="admin", description="Админ-панель"),
-            BotCommand(command="broadcast", description="Рассылка от администратора"),
-            BotCommand(command="iqtest", description="Пройти IQ Тест")
-        ])
+        await bot.set_my_commands(BOT_COMMANDS)
         logger.info("Команды бота успешно установлены.")
     except Exception as e:
-        logger.error(f"Ошибка установки команд бота: {e}")
+        logger.error("Ошибка установки команд бота: %s", e)
 
 # === FastAPI Startup Event ===
 @app.on_event("startup")
 async def startup_event():
     """Выполняется при запуске FastAPI приложения."""
-    init_db() # Инициализируем базу данных
+    await init_db() # Инициализируем базу данных
     await setup_bot_commands() # Устанавливаем команды бота
+    start_activity_flusher() # Запускаем пакетную запись активности пользователей
+    start_photo_workers() # Запускаем воркеры обработки фото
     logger.info("FastAPI startup events completed.")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Выполняется при остановке FastAPI приложения."""
+    await stop_photo_workers() # Останавливаем воркеры обработки фото
+    await stop_activity_flusher() # Записываем оставшуюся активность пользователей
+    await pool.close() # Закрываем соединения с базой данных
+    await openai_http.aclose() # Закрываем HTTP-клиент OpenAI
+    await bot.session.close() # Закрываем сессию aiogram
+    logger.info("FastAPI shutdown events completed.")
+
 # === Состояния FSM (Finite State Machine) ===
 class GenStates(StatesGroup):
     """Определяет состояния для FSM."""
@@ -110,71 +330,656 @@ class GenStates(StatesGroup):
     await_broadcast = State()
 
 # === Главное меню ===
-def main_menu():
-    """Возвращает объект ReplyKeyboardMarkup для главного меню бота."""
-    kb = [
+# Клавиатура создается один раз при импорте модуля и переиспользуется при каждом /start и /menu
+_MAIN_MENU = ReplyKeyboardMarkup(
+    keyboard=[
         [KeyboardButton(text="🍱 Узнать калории по фото")],
         [KeyboardButton(text="📸 Сделать фото"), KeyboardButton(text="🏋️ Программы тренировок")],
         [KeyboardButton(text="📚 Как пользоваться?"), KeyboardButton(text="💳 Оплата подписки")],
         [KeyboardButton(text="👤 Профиль"), KeyboardButton(text="🧠 IQ Тест")]
-    ]
-    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
+    ],
+    resize_keyboard=True
+)
+
+def main_menu():
+    """Возвращает объект ReplyKeyboardMarkup для главного меню бота."""
+    return _MAIN_MENU
 
 # === Хелперы (вспомогательные функции) ===
-def ensure_user(user_id: int):
+_TS_CACHE = [0.0, ""] # [время создания, строка ISO] последней метки времени
+
+def now_iso() -> str:
+    """
+    Возвращает текущее время UTC в формате ISO.
+    Строка пересоздается не чаще раза в секунду — для last_active такой точности достаточно.
+    """
+    t = time.time()
+    if t - _TS_CACHE[0] >= 1.0:
+        _TS_CACHE[:] = [t, datetime.utcfromtimestamp(t).isoformat()]
+    return _TS_CACHE[1]
+
+async def bulk_ensure_users(activity: Dict[int, str]):
+    """
+    Добавляет пользователей и обновляет время их последней активности (user_id -> время).
+    Все строки записываются через executemany в одной транзакции — один коммит вместо N.
+    """
+    if not activity:
+        return
+    async with pool.write() as db:
+        await db.executemany(SQL_UPSERT_USER, list(activity.items()))
+
+async def ensure_user(user_id: int):
     """
     Проверяет существование пользователя в базе данных.
     Если пользователь не найден, добавляет его с начальным лимитом использований.
     Обновляет время последней активности пользователя.
+    Новые пользователи записываются сразу, а обновление активности уже известных
+    откладывается и записывается пачкой (см. activity_flusher).
     """
-    now = datetime.utcnow().isoformat()
+    now = now_iso()
+    if user_id in known_users:
+        pending_activity[user_id] = now
+        if len(pending_activity) >= ACTIVITY_BATCH_SIZE and activity_event is not None:
+            activity_event.set()
+        return
     try:
-        cursor.execute("""
-            INSERT INTO users (user_id, last_active)
-            VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET last_active=excluded.last_active
-        """, (user_id, now))
-        conn.commit()
-        logger.info(f"Пользователь {user_id} проверен/добавлен в БД.")
+        await bulk_ensure_users({user_id: now})
+        known_users.add(user_id)
+        logger.debug("Пользователь %s проверен/добавлен в БД.", user_id)
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при проверке/добавлении пользователя {user_id}: {e}")
+        logger.error("Ошибка при проверке/добавлении пользователя %s: %s", user_id, e)
+
+async def flush_activity():
+    """Записывает накопленные обновления активности пользователей."""
+    if not pending_activity:
+        return
+    activity = dict(pending_activity)
+    pending_activity.clear()
+    try:
+        await bulk_ensure_users(activity)
+    except BaseException:
+        # Запись не удалась или прервана — возвращаем пачку, не затирая более свежие обновления
+        for user_id, ts in activity.items():
+            pending_activity.setdefault(user_id, ts)
+        raise
+
+async def activity_flusher():
+    """Записывает активность пользователей раз в ACTIVITY_FLUSH_INTERVAL или при накоплении ACTIVITY_BATCH_SIZE."""
+    while True:
+        try:
+            await asyncio.wait_for(activity_event.wait(), ACTIVITY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        activity_event.clear()
+        try:
+            await flush_activity()
+        except Exception as e:
+            # Любая ошибка записи не должна останавливать фоновую задачу — пачка будет записана в следующий раз
+            logger.error("Ошибка при записи активности %s пользователей: %s", len(pending_activity), e)
+
+def start_activity_flusher():
+    """Запускает фоновую запись активности пользователей."""
+    global activity_event, activity_task
+    activity_event = asyncio.Event()
+    activity_task = asyncio.create_task(activity_flusher())
+
+async def stop_activity_flusher():
+    """Останавливает фоновую запись и сохраняет то, что осталось."""
+    global activity_task
+    if activity_task is not None:
+        activity_task.cancel()
+        await asyncio.gather(activity_task, return_exceptions=True)
+        activity_task = None
+    try:
+        await flush_activity()
+    except Exception as e:
+        logger.error("Не удалось записать активность %s пользователей при остановке: %s", len(pending_activity), e)
 
-def get_user_stats():
-    """Возвращает общую статистику по пользователям."""
+async def get_uses_left(user_id: int) -> Optional[int]:
+    """
+    Возвращает количество оставшихся использований или None, если пользователя нет в БД.
+    Значение берется из кэша; кэш обновляется при каждом изменении uses_left.
+    """
+    uses_left = USES_CACHE.get(user_id)
+    if uses_left is not None:
+        return uses_left
+    async with pool.acquire() as db:
+        async with db.execute(SQL_GET_USES, (user_id,)) as cur:
+            row = await cur.fetchone()
+    if row is None:
+        return None
+    USES_CACHE[user_id] = row[0]
+    return row[0]
+
+async def get_user_stats():
+    """Возвращает общую статистику по пользователям (кэшируется на STATS_CACHE_TTL секунд)."""
+    cached = STATS_CACHE.get("user_stats")
+    if cached is not None:
+        return cached
     try:
-        cursor.execute("SELECT COUNT(*), SUM(uses_left) FROM users")
-        total_users, total_uses = cursor.fetchone()
-        cursor.execute("SELECT COUNT(*) FROM users WHERE uses_left < ?", (FREE_USES_LIMIT,))
-        paid_users = cursor.fetchone()[0]
+        async with pool.acquire() as db:
+            async with db.execute(SQL_USER_TOTALS) as cur:
+                total_users, total_uses = await cur.fetchone()
+            async with db.execute(SQL_COUNT_USED, (FREE_USES_LIMIT,)) as cur:
+                paid_users = (await cur.fetchone())[0]
+        STATS_CACHE["user_stats"] = (total_users, total_uses, paid_users)
         return total_users, total_uses, paid_users
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при получении статистики пользователей: {e}")
+        logger.error("Ошибка при получении статистики пользователей: %s", e)
         return 0, 0, 0
 
-def get_generation_count():
-    """Возвращает количество пользователей, которые использовали бота (т.е. их uses_left уменьшился)."""
+async def get_generation_count():
+    """
+    Возвращает количество пользователей, которые использовали бота (т.е. их uses_left уменьшился).
+    Кэшируется на STATS_CACHE_TTL секунд.
+    """
+    cached = STATS_CACHE.get("generation_count")
+    if cached is not None:
+        return cached
     try:
-        cursor.execute("SELECT COUNT(*) FROM users WHERE uses_left < ?", (FREE_USES_LIMIT,))
-        return cursor.fetchone()[0]
+        async with pool.acquire() as db:
+            async with db.execute(SQL_COUNT_USED, (FREE_USES_LIMIT,)) as cur:
+                count = (await cur.fetchone())[0]
+        STATS_CACHE["generation_count"] = count
+        return count
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при получении количества генераций: {e}")
+        logger.error("Ошибка при получении количества генераций: %s", e)
         return 0
 
+async def iter_user_ids(batch_size: int = BROADCAST_BATCH):
+    """
+    Постранично выдает ID всех пользователей.
+    Таблица не загружается в память целиком, а соединение на чтение не занимается на всё время рассылки.
+    """
+    last_id = -(2 ** 63)
+    while True:
+        async with pool.acquire() as db:
+            async with db.execute(SQL_USER_IDS_PAGE, (last_id, batch_size)) as cur:
+                rows = await cur.fetchall()
+        if not rows:
+            return
+        for (user_id,) in rows:
+            yield user_id
+        last_id = rows[-1][0]
+
+async def send_with_retry(chat_id: int, text: str, limiter: AsyncLimiter) -> bool:
+    """
+    Отправляет сообщение с учетом лимита скорости.
+    При ошибках повторяет попытку с экспоненциальной задержкой (или ждет retry_after от Telegram).
+    """
+    last_error = None
+    for attempt in range(BROADCAST_RETRIES):
+        try:
+            async with limiter:
+                await bot.send_message(chat_id=chat_id, text=text)
+            return True
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Пользователь заблокировал бота, чат удален или не найден — повторять бессмысленно
+            logger.warning("Не удалось отправить сообщение пользователю %s: %s", chat_id, e)
+            return False
+        except Exception as e:
+            last_error = e
+            if attempt < BROADCAST_RETRIES - 1:
+                delay = e.retry_after if isinstance(e, TelegramRetryAfter) else 2 ** attempt
+                await asyncio.sleep(delay)
+    logger.warning("Не удалось отправить сообщение пользователю %s после %s попыток: %s", chat_id, BROADCAST_RETRIES, last_error)
+    return False
+
+async def broadcast_message(text: str):
+    """
+    Рассылает текст всем пользователям с ограничением числа одновременных отправок и скорости.
+    Возвращает кортеж (успешно, с ошибкой).
+    """
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    limiter = AsyncLimiter(BROADCAST_RATE, 1)
+    tasks = set()
+    success, failed = 0, 0
+
+    async def _send(user_id: int):
+        nonlocal success, failed
+        try:
+            if await send_with_retry(user_id, text, limiter):
+                success += 1
+            else:
+                failed += 1
+        finally:
+            sem.release()
+
+    async for user_id in iter_user_ids():
+        await sem.acquire() # Не создаем больше задач, чем разрешено одновременных отправок
+        task = asyncio.create_task(_send(user_id))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return success, failed
+
+CONSUME_FAILED = object() # Результат consume_use при ошибке БД (в отличие от None — "лимит исчерпан")
+
+async def consume_use(user_id: int):
+    """
+    Атомарно списывает одно использование.
+    Возвращает (оставшееся количество, включен ли эконом-режим), None, если лимит исчерпан,
+    или CONSUME_FAILED при ошибке базы данных.
+    """
+    try:
+        async with pool.write() as db:
+            cur = await db.execute(SQL_CONSUME_USE, (user_id,))
+            row = None
+            if cur.rowcount > 0:
+                async with db.execute(SQL_GET_USE_STATE, (user_id,)) as cur:
+                    row = await cur.fetchone()
+    except sqlite3.Error as e:
+        logger.error("Ошибка при списании использования у пользователя %s: %s", user_id, e)
+        return CONSUME_FAILED
+    if row is None:
+        USES_CACHE.pop(user_id, None)
+        return None
+    USES_CACHE[user_id] = row[0]
+    logger.debug("Счетчик использований для пользователя %s уменьшен. Осталось: %s.", user_id, row[0])
+    return row[0], bool(row[1])
+
+async def refund_use(user_id: int):
+    """Возвращает пользователю одно использование (например, если запрос к OpenAI не удался)."""
+    try:
+        async with pool.write() as db:
+            await db.execute(SQL_REFUND_USE, (user_id,))
+            async with db.execute(SQL_GET_USES, (user_id,)) as cur:
+                row = await cur.fetchone()
+        if row is not None:
+            USES_CACHE[user_id] = row[0]
+        logger.info("Пользователю %s возвращено одно использование.", user_id)
+    except sqlite3.Error as e:
+        logger.error("Ошибка при возврате использования пользователю %s: %s", user_id, e)
+
+def encode_image(buffer: BytesIO) -> str:
+    """
+    Уменьшает фото до IMAGE_MAX_SIDE по длинной стороне, пережимает в JPEG и кодирует в base64.
+    Выполняется в отдельном потоке (см. process_photo_job), так как Pillow работает синхронно.
+    """
+    buffer.seek(0)
+    try:
+        with Image.open(buffer) as img:
+            img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+            compressed = BytesIO()
+            img.convert("RGB").save(compressed, "JPEG", quality=IMAGE_QUALITY, optimize=True)
+        buffer = compressed
+    except OSError as e:
+        # Не удалось разобрать изображение — отправляем как есть
+        logger.warning("Не удалось сжать изображение: %s", e)
+    # Кодируем через memoryview, без промежуточной копии bytes
+    return base64.b64encode(buffer.getbuffer()).decode("ascii")
+
 async def send_photo_or_text(chat_id: int, img_path: str, caption: str, parse_mode: str = None):
     """
     Отправляет фото с подписью. Если фото не найдено, отправляет только текст.
+    Каждая картинка загружается в Telegram один раз, дальше отправляется по file_id.
     """
+    file_id = IMG_FILE_IDS.get(img_path)
+    if file_id:
+        try:
+            await bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, parse_mode=parse_mode)
+            logger.debug("Фото %s успешно отправлено пользователю %s.", img_path, chat_id)
+            return
+        except TelegramBadRequest as e:
+            if not is_file_id_error(e):
+                logger.error("Ошибка при отправке фото %s пользователю %s: %s", img_path, chat_id, e)
+                await send_text_fallback(chat_id, f"🖼️ Не удалось загрузить изображение. {caption}", parse_mode)
+                return
+            # file_id стал недействительным — загружаем файл заново
+            logger.warning("Недействительный file_id фото %s, загружаю заново: %s", img_path, e)
+            IMG_FILE_IDS.pop(img_path, None)
+        except Exception as e:
+            # Пользователь заблокировал бота, флуд-лимит, сетевая ошибка — повторная загрузка не поможет
+            logger.error("Ошибка при отправке фото %s пользователю %s: %s", img_path, chat_id, e)
+            await send_text_fallback(chat_id, f"🖼️ Не удалось загрузить изображение. {caption}", parse_mode)
+            return
+
     full_img_path = os.path.join(IMG_DIR, img_path)
     if os.path.exists(full_img_path):
         try:
-            await bot.send_photo(chat_id=chat_id, photo=types.FSInputFile(full_img_path), caption=caption, parse_mode=parse_mode)
-            logger.info(f"Фото {img_path} успешно отправлено пользователю {chat_id}.")
+            sent = await bot.send_photo(chat_id=chat_id, photo=types.FSInputFile(full_img_path), caption=caption, parse_mode=parse_mode)
+            IMG_FILE_IDS[img_path] = sent.photo[-1].file_id
+            logger.debug("Фото %s успешно отправлено пользователю %s.", img_path, chat_id)
         except Exception as e:
-            logger.error(f"Ошибка при отправке фото {img_path} пользователю {chat_id}: {e}")
-            await bot.send_message(chat_id=chat_id, text=f"🖼️ Не удалось загрузить изображение. {caption}", parse_mode=parse_mode)
+            logger.error("Ошибка при отправке фото %s пользователю %s: %s", img_path, chat_id, e)
+            await send_text_fallback(chat_id, f"🖼️ Не удалось загрузить изображение. {caption}", parse_mode)
     else:
-        logger.warning(f"Файл изображения не найден: {full_img_path}. Отправляю только текст.")
-        await bot.send_message(chat_id=chat_id, text=f"🖼️ Изображение не найдено. {caption}", parse_mode=parse_mode)
+        logger.warning("Файл изображения не найден: %s. Отправляю только текст.", full_img_path)
+        await send_text_fallback(chat_id, f"🖼️ Изображение не найдено. {caption}", parse_mode)
+
+def is_file_id_error(error: TelegramBadRequest) -> bool:
+    """Проверяет, что Telegram отклонил именно file_id (недействительный идентификатор или ссылка на файл)."""
+    text = str(error).lower()
+    return "file identifier" in text or "file reference" in text or "file_id" in text
+
+async def send_text_fallback(chat_id: int, text: str, parse_mode: str = None):
+    """Отправляет текст вместо картинки; ошибки только логируются."""
+    try:
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+    except Exception as e:
+        logger.error("Не удалось отправить сообщение пользователю %s: %s", chat_id, e)
+
+# === Очередь обработки фото ===
+class PhotoJob(NamedTuple):
+    """Задание на анализ фото, которое обрабатывает воркер."""
+    user_id: int
+    chat_id: int
+    file_id: str
+    message_id: int # ID сообщения "Обрабатываю...", которое заменяется результатом
+    username: Optional[str]
+    economy: bool = False # Отправить фото в пакет OpenAI Batch API вместо немедленного анализа
+
+photo_queue: Optional[asyncio.Queue] = None
+openai_sem: Optional[asyncio.Semaphore] = None
+photo_workers: List[asyncio.Task] = []
+
+def build_vision_request(image_b64: str) -> dict:
+    """Возвращает параметры запроса к OpenAI для анализа фото (общие для обычного и эконом-режима)."""
+    return {
+        "model": "gpt-4o", # Используем модель gpt-4o для анализа изображений
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "Что изображено на фото? Укажи примерную калорийность блюда, а также содержание белков, жиров и углеводов (БЖУ) в граммах. Отвечай только на русском языке."},
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}", "detail": IMAGE_DETAIL}}
+                ]
+            }
+        ],
+        "max_tokens": 500 # Максимальное количество токенов в ответе
+    }
+
+async def analyze_photo(image_b64: str) -> str:
+    """
+    Отправляет фото в OpenAI и возвращает текст ответа.
+    Одновременных запросов не больше OPENAI_CONCURRENCY; при ошибках лимитов, соединения
+    и ошибках сервера OpenAI (5xx) запрос повторяется с экспоненциальной задержкой.
+    """
+    for attempt in range(OPENAI_RETRIES):
+        try:
+            async with openai_sem:
+                response = await openai_client.chat.completions.create(**build_vision_request(image_b64))
+            return response.choices[0].message.content
+        except (RateLimitError, APIConnectionError, InternalServerError) as e:
+            if attempt == OPENAI_RETRIES - 1:
+                raise
+            delay = 2 ** attempt
+            logger.warning("Ошибка запроса к OpenAI (%s), повтор через %s с.", e, delay)
+            await asyncio.sleep(delay)
+
+async def reply_to_job(job: PhotoJob, text: str):
+    """
+    Сообщает пользователю результат задания.
+    Обычно текст заменяет сообщение "Обрабатываю...". В эконом-режиме ответ приходит спустя часы,
+    а правка сообщения не вызывает уведомления, поэтому отправляется новое сообщение в ответ на него.
+    """
+    if job.economy:
+        await bot.send_message(
+            chat_id=job.chat_id, text=text,
+            reply_to_message_id=job.message_id, allow_sending_without_reply=True
+        )
+    else:
+        await bot.edit_message_text(text=text, chat_id=job.chat_id, message_id=job.message_id)
+
+async def fail_job(job: PhotoJob, text: str = "❌ Ошибка при обработке изображения. Попробуйте ещё раз позже."):
+    """Возвращает списанное использование и сообщает пользователю об ошибке."""
+    await refund_use(job.user_id)
+    try:
+        await reply_to_job(job, text)
+    except Exception as e:
+        logger.warning("Не удалось сообщить пользователю %s об ошибке: %s", job.user_id, e)
+
+async def process_photo_job(job: PhotoJob):
+    """Скачивает фото, анализирует его и заменяет сообщение "Обрабатываю..." результатом."""
+    answer = None
+    batched = False
+    try:
+        # Скачиваем фото сразу в буфер, сжимаем и кодируем в base64 в отдельном потоке, не блокируя event loop
+        image_buffer = BytesIO()
+        await bot.download(job.file_id, destination=image_buffer)
+        image_b64 = await asyncio.to_thread(encode_image, image_buffer)
+
+        if job.economy:
+            # С этого момента фото лежит в batch_queue: при остановке его отправит stop_photo_workers
+            batched = True
+            await add_to_batch(job, image_b64)
+            return
+
+        answer = await analyze_photo(image_b64)
+        await deliver_answer(job, answer)
+
+    except asyncio.CancelledError:
+        # Бот останавливается посреди обработки — возвращаем использование, если ответ не получен
+        # и фото не передано в пакет эконом-режима
+        if answer is None and not batched:
+            await asyncio.shield(fail_job(job, RESTART_TEXT))
+        raise
+    except Exception as e:
+        logger.exception("Ошибка при обработке изображения для пользователя %s: %s", job.user_id, e)
+        if answer is None:
+            # Ответ не получен — возвращаем списанное использование и сообщаем об ошибке
+            await fail_job(job)
+
+async def deliver_answer(job: PhotoJob, answer: str):
+    """Отправляет ответ пользователю (см. reply_to_job) и уведомляет канал."""
+    # Отправка результата пользователю
+    await reply_to_job(job, f"📊 Ответ:\n{answer}")
+    logger.debug("Пользователь %s получил ответ от OpenAI с калориями и БЖУ.", job.user_id)
+
+    # Отправка уведомления в канал (если CHANNEL_ID установлен)
+    if CHANNEL_ID:
+        username_or_id = f"@{job.username}" if job.username else f"ID: {job.user_id}"
+        try:
+            await bot.send_message(
+                chat_id=CHANNEL_ID,
+                text=f"📷 Пользователь {username_or_id} загрузил фото еды. Калории и БЖУ вычислены."
+            )
+            logger.debug("Уведомление о фото от %s отправлено в канал.", job.user_id)
+        except Exception as e:
+            logger.error("Не удалось отправить уведомление в канал %s: %s", CHANNEL_ID, e)
+
+async def photo_worker():
+    """Бесконечно разбирает очередь фото."""
+    while True:
+        job = await photo_queue.get()
+        try:
+            await process_photo_job(job)
+        finally:
+            photo_queue.task_done()
+
+def start_photo_workers():
+    """Создает очередь фото и запускает воркеры, а также фоновую задачу эконом-режима."""
+    global photo_queue, openai_sem, batch_lock
+    photo_queue = asyncio.Queue()
+    openai_sem = asyncio.Semaphore(OPENAI_CONCURRENCY)
+    batch_lock = asyncio.Lock()
+    for _ in range(PHOTO_WORKERS):
+        photo_workers.append(asyncio.create_task(photo_worker()))
+    photo_workers.append(asyncio.create_task(batch_loop()))
+    logger.info("Запущено воркеров обработки фото: %s.", PHOTO_WORKERS)
+
+async def stop_photo_workers():
+    """
+    Останавливает воркеры обработки фото и отправляет накопленный пакет эконом-режима.
+    Сначала ждет до PHOTO_DRAIN_TIMEOUT секунд, пока очередь разберется; задания, которые
+    не успели обработаться, завершаются с возвратом списанного использования.
+    """
+    if photo_queue is not None:
+        try:
+            await asyncio.wait_for(photo_queue.join(), PHOTO_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь фото не разобрана за %s с, осталось заданий: %s.", PHOTO_DRAIN_TIMEOUT, photo_queue.qsize())
+    for task in photo_workers:
+        task.cancel()
+    await asyncio.gather(*photo_workers, return_exceptions=True)
+    photo_workers.clear()
+    while photo_queue is not None and not photo_queue.empty():
+        await fail_job(photo_queue.get_nowait(), RESTART_TEXT)
+    await flush_batch()
+
+# === Эконом-режим (OpenAI Batch API) ===
+# Фото пользователей в эконом-режиме не анализируются сразу, а копятся в пакет и отправляются
+# в Batch API: это вдвое дешевле и не расходует обычный лимит запросов, но ответ приходит до 24 часов.
+# Отправленные пакеты хранятся в таблице batch_jobs, поэтому результаты не теряются при перезапуске.
+batch_queue: List[Tuple[PhotoJob, str]] = [] # (задание, фото в base64), еще не отправленные в OpenAI
+batch_lock: Optional[asyncio.Lock] = None
+# Для Batch API повторы SDK включены: без них одна временная ошибка провалила бы весь пакет
+batch_client = openai_client.with_options(max_retries=BATCH_API_RETRIES)
+
+def build_batch_file(items: List[Tuple[PhotoJob, str]]) -> bytes:
+    """Собирает JSONL-файл для Batch API: одна строка на фото."""
+    lines = [
+        json.dumps({
+            "custom_id": f"{job.chat_id}:{job.message_id}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_vision_request(image_b64),
+        }, ensure_ascii=False)
+        for job, image_b64 in items
+    ]
+    return "\n".join(lines).encode("utf-8")
+
+async def add_to_batch(job: PhotoJob, image_b64: str):
+    """Добавляет фото в накапливаемый пакет; полный пакет отправляется сразу."""
+    batch_queue.append((job, image_b64))
+    logger.debug("Фото пользователя %s добавлено в пакет эконом-режима. В пакете: %s.", job.user_id, len(batch_queue))
+    if len(batch_queue) >= BATCH_MAX_SIZE:
+        await flush_batch()
+
+async def submit_batch(items: List[Tuple[PhotoJob, str]]) -> str:
+    """Загружает JSONL-файл и создает пакет в OpenAI Batch API. Возвращает ID пакета."""
+    data = await asyncio.to_thread(build_batch_file, items)
+    batch_file = await batch_client.files.create(file=("batch.jsonl", data), purpose="batch")
+    batch = await batch_client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+async def record_batch(batch_id: str, items: List[Tuple[PhotoJob, str]]):
+    """Сохраняет задания отправленного пакета в БД, повторяя попытку при ошибках."""
+    rows = [
+        (f"{job.chat_id}:{job.message_id}", batch_id, job.user_id, job.chat_id, job.message_id, job.username)
+        for job, _ in items
+    ]
+    for attempt in range(BATCH_RECORD_RETRIES):
+        try:
+            async with pool.write() as db:
+                await db.executemany(SQL_ADD_BATCH_JOB, rows)
+            return
+        except sqlite3.Error as e:
+            if attempt == BATCH_RECORD_RETRIES - 1:
+                raise
+            logger.warning("Не удалось сохранить пакет %s (%s), повтор через %s с.", batch_id, e, 2 ** attempt)
+            await asyncio.sleep(2 ** attempt)
+
+async def flush_batch():
+    """Отправляет накопленные фото в OpenAI Batch API и сохраняет задания в БД."""
+    async with batch_lock:
+        if not batch_queue:
+            return
+        items = batch_queue[:]
+        batch_queue.clear()
+        try:
+            batch_id = await submit_batch(items)
+        except asyncio.CancelledError:
+            # Возвращаем фото в пакет — при остановке stop_photo_workers отправит его еще раз
+            batch_queue[:0] = items
+            raise
+        except Exception as e:
+            # Пакет не создан — возвращаем использования
+            logger.exception("Ошибка при отправке пакета фото в OpenAI Batch API: %s", e)
+            for job, _ in items:
+                await fail_job(job)
+            return
+
+        try:
+            # Пакет уже выполняется в OpenAI: запись в БД не должна прерываться отменой задачи
+            await asyncio.shield(record_batch(batch_id, items))
+            logger.info("Пакет %s из %s фото отправлен в OpenAI Batch API.", batch_id, len(items))
+        except Exception as e:
+            # Без записи в БД ответы доставить некому — отменяем пакет и только потом возвращаем использования
+            logger.exception("Пакет %s создан, но не сохранен в БД: %s. Отменяю пакет.", batch_id, e)
+            try:
+                await batch_client.batches.cancel(batch_id)
+            except Exception as cancel_error:
+                logger.error("Не удалось отменить пакет %s: %s", batch_id, cancel_error)
+            for job, _ in items:
+                await fail_job(job)
+
+async def finish_batch_job(custom_id: str, job: PhotoJob, answer: Optional[str]):
+    """Отправляет ответ из пакета (или возвращает использование, если ответа нет) и удаляет задание из БД."""
+    if answer is None:
+        await fail_job(job)
+    else:
+        try:
+            await deliver_answer(job, answer)
+        except Exception as e:
+            logger.warning("Не удалось отправить ответ эконом-режима пользователю %s: %s", job.user_id, e)
+    async with pool.write() as db:
+        await db.execute(SQL_DELETE_BATCH_JOB, (custom_id,))
+
+async def check_batches():
+    """
+    Проверяет отправленные пакеты и рассылает ответы по завершенным.
+    Каждое задание удаляется из БД сразу после обработки, поэтому при остановке бота
+    посреди рассылки уже отправленные ответы и возвраты не повторяются после перезапуска.
+    """
+    async with pool.acquire() as db:
+        async with db.execute(SQL_PENDING_BATCHES) as cur:
+            batch_ids = [row[0] for row in await cur.fetchall()]
+
+    for batch_id in batch_ids:
+        try:
+            batch = await batch_client.batches.retrieve(batch_id)
+        except Exception as e:
+            logger.warning("Не удалось получить статус пакета %s: %s", batch_id, e)
+            continue
+        if batch.status not in ("completed", "failed", "expired", "cancelled"):
+            continue
+
+        async with pool.acquire() as db:
+            async with db.execute(SQL_BATCH_JOBS, (batch_id,)) as cur:
+                jobs = {
+                    custom_id: PhotoJob(user_id, chat_id, "", message_id, username, economy=True)
+                    for custom_id, user_id, chat_id, message_id, username in await cur.fetchall()
+                }
+
+        answers = {}
+        # Частичный результат бывает и у пакетов expired/cancelled — читаем его при любом завершенном статусе
+        if batch.output_file_id:
+            try:
+                content = await batch_client.files.content(batch.output_file_id)
+                for line in content.text.splitlines():
+                    result = json.loads(line)
+                    response = result.get("response") or {}
+                    if response.get("status_code") == 200:
+                        answers[result["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+            except Exception as e:
+                logger.exception("Ошибка при чтении результатов пакета %s: %s", batch_id, e)
+                continue
+
+        for custom_id, job in jobs.items():
+            task = asyncio.ensure_future(finish_batch_job(custom_id, job, answers.get(custom_id)))
+            try:
+                await asyncio.shield(task)
+            except asyncio.CancelledError:
+                # Бот останавливается: доводим текущее задание до конца, остальные обработаются после перезапуска
+                await asyncio.wait({task})
+                raise
+        logger.info("Пакет %s обработан (%s). Ответов: %s из %s.", batch_id, batch.status, len(answers), len(jobs))
+
+async def batch_loop():
+    """Периодически отправляет накопленный пакет и проверяет готовность отправленных."""
+    while True:
+        await asyncio.sleep(BATCH_FLUSH_INTERVAL)
+        try:
+            await flush_batch()
+            await check_batches()
+        except Exception as e:
+            logger.exception("Ошибка в фоновой задаче эконом-режима: %s", e)
 
 # === Обработчики команд ===
 
@@ -184,8 +989,8 @@ async def cmd_stats(message: Message):
     if message.from_user.id != ADMIN_ID:
         return await message.answer("🚫 Нет доступа.")
 
-    total, _, paid = get_user_stats()
-    active = get_generation_count()
+    total, _, paid = await get_user_stats()
+    active = await get_generation_count()
 
     await message.answer(
         f"📊 Статистика:\n"
@@ -193,7 +998,7 @@ async def cmd_stats(message: Message):
         f"💸 С подпиской: {paid}\n"
         f"📈 Активных генераций: {active}"
     )
-    logger.info(f"Администратор {message.from_user.id} запросил статистику.")
+    logger.info("Администратор %s запросил статистику.", message.from_user.id)
 
 @dp.message(Command("users"))
 async def cmd_list_users(message: Message):
@@ -202,19 +1007,21 @@ async def cmd_list_users(message: Message):
         return await message.answer("🚫 Нет доступа.")
     
     try:
-        cursor.execute("SELECT user_id, uses_left, last_active FROM users ORDER BY last_active DESC LIMIT 20")
-        rows = cursor.fetchall()
-        if not rows:
+        # Строки читаем прямо из курсора, без промежуточного списка fetchall()
+        lines = []
+        async with pool.acquire() as db:
+            async with db.execute(SQL_LAST_USERS) as cur:
+                async for uid, uses, last in cur:
+                    lines.append(f"🆔 {uid} — Осталось: {uses} — Активен: {last}\n")
+        if not lines:
             return await message.answer("❌ Пользователей нет.")
         
-        text = "🧾 Последние пользователи:\n\n"
-        for uid, uses, last in rows:
-            text += f"🆔 {uid} — Осталось: {uses} — Активен: {last}\n"
+        text = "🧾 Последние пользователи:\n\n" + "".join(lines)
         
         await message.answer(text)
-        logger.info(f"Администратор {message.from_user.id} запросил список пользователей.")
+        logger.info("Администратор %s запросил список пользователей.", message.from_user.id)
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при получении списка пользователей для администратора: {e}")
+        logger.error("Ошибка при получении списка пользователей для администратора: %s", e)
         await message.answer("❌ Произошла ошибка при получении списка пользователей.")
 
 @dp.message(Command("broadcast"))
@@ -225,7 +1032,7 @@ async def cmd_broadcast(message: Message, state: FSMContext):
         return
     await message.answer("✏️ Введите текст рассылки:")
     await state.set_state(GenStates.await_broadcast)
-    logger.info(f"Администратор {message.from_user.id} инициировал рассылку.")
+    logger.info("Администратор %s инициировал рассылку.", message.from_user.id)
 
 @dp.message(GenStates.await_broadcast)
 async def process_broadcast(message: Message, state: FSMContext):
@@ -237,28 +1044,18 @@ async def process_broadcast(message: Message, state: FSMContext):
         return
 
     try:
-        cursor.execute("SELECT user_id FROM users")
-        users = cursor.fetchall()
-        success, failed = 0, 0
-        for user in users:
-            try:
-                await bot.send_message(chat_id=user[0], text=text)
-                success += 1
-                await asyncio.sleep(0.05) # Небольшая задержка для избежания флуда
-            except Exception as e:
-                logger.warning(f"Не удалось отправить сообщение пользователю {user[0]}: {e}")
-                failed += 1
-        
+        success, failed = await broadcast_message(text)
+
         if CHANNEL_ID:
             try:
                 await bot.send_message(chat_id=CHANNEL_ID, text=f"📢 Новая рассылка: {text}")
             except Exception as e:
-                logger.error(f"Не удалось отправить уведомление о рассылке в канал {CHANNEL_ID}: {e}")
+                logger.error("Не удалось отправить уведомление о рассылке в канал %s: %s", CHANNEL_ID, e)
 
         await message.answer(f"✅ Рассылка завершена\nОтправлено: {success}\nОшибок: {failed}")
-        logger.info(f"Рассылка завершена. Отправлено: {success}, Ошибок: {failed}.")
+        logger.info("Рассылка завершена. Отправлено: %s, Ошибок: %s.", success, failed)
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при получении списка пользователей для рассылки: {e}")
+        logger.error("Ошибка при получении списка пользователей для рассылки: %s", e)
         await message.answer("❌ Произошла ошибка при выполнении рассылки.")
     finally:
         await state.clear()
@@ -275,50 +1072,44 @@ async def cmd_find_user(message: Message):
         return
     try:
         target_id = int(parts[1])
-        cursor.execute("SELECT uses_left FROM users WHERE user_id = ?", (target_id,))
-        row = cursor.fetchone()
-        if row:
-            await message.answer(f"👤 Пользователь {target_id} найден. Осталось использований: {row[0]}")
-            logger.info(f"Администратор {message.from_user.id} нашел пользователя {target_id}.")
+        uses_left = await get_uses_left(target_id)
+        if uses_left is not None:
+            await message.answer(f"👤 Пользователь {target_id} найден. Осталось использований: {uses_left}")
+            logger.info("Администратор %s нашел пользователя %s.", message.from_user.id, target_id)
         else:
             await message.answer("❌ Пользователь не найден.")
-            logger.info(f"Администратор {message.from_user.id} не нашел пользователя {target_id}.")
+            logger.info("Администратор %s не нашел пользователя %s.", message.from_user.id, target_id)
     except ValueError:
         await message.answer("❌ ID пользователя должен быть числом.")
-        logger.warning(f"Администратор {message.from_user.id} ввел некорректный ID: {parts[1]}.")
+        logger.warning("Администратор %s ввел некорректный ID: %s.", message.from_user.id, parts[1])
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при поиске пользователя {target_id}: {e}")
+        logger.error("Ошибка при поиске пользователя %s: %s", target_id, e)
         await message.answer("❌ Ошибка при поиске пользователя в базе данных.")
 
-@dp.message(F.text.in_(["/start", "/menu"]))
 async def cmd_start(message: Message, state: FSMContext):
     """Обработчик команд /start и /menu."""
-    ensure_user(message.from_user.id)
+    await ensure_user(message.from_user.id)
     await message.answer("👋 Добро пожаловать! Выберите действие:", reply_markup=main_menu())
     await state.clear() # Очищаем состояние, если пользователь вернулся в меню
-    logger.info(f"Пользователь {message.from_user.id} запустил бота или открыл меню.")
+    logger.debug("Пользователь %s запустил бота или открыл меню.", message.from_user.id)
 
-@dp.message(F.text == "/profile")
-@dp.message(F.text == "👤 Профиль")
-async def cmd_profile(message: Message):
+async def cmd_profile(message: Message, state: FSMContext):
     """Обработчик команды /profile и кнопки 'Профиль'."""
     user_id = message.from_user.id
-    ensure_user(user_id)
-    cursor.execute("SELECT uses_left FROM users WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
+    await ensure_user(user_id)
+    uses_left = await get_uses_left(user_id)
 
-    caption = f"👤 Профиль:\nID: {user_id}\nОсталось использований: {row[0] if row else 0}"
+    caption = f"👤 Профиль:\nID: {user_id}\nОсталось использований: {uses_left or 0}"
     await send_photo_or_text(message.chat.id, "profile.png", caption)
-    logger.info(f"Пользователь {user_id} запросил профиль.")
+    logger.debug("Пользователь %s запросил профиль.", user_id)
 
-@dp.message(F.text == "/admin")
-async def cmd_admin(message: Message):
+async def cmd_admin(message: Message, state: FSMContext):
     """Обработчик команды /admin для администратора."""
     if message.from_user.id != ADMIN_ID:
         await message.answer("🚫 У вас нет доступа к этой команде.")
         return
 
-    total_users, total_uses, paid_users = get_user_stats()
+    total_users, total_uses, paid_users = await get_user_stats()
 
     await message.answer(
         f"🛠 <b>Админ-панель</b>\n\n"
@@ -326,7 +1117,28 @@ async def cmd_admin(message: Message):
         f"🔄 Общих использований осталось: {total_uses or 0}\n"
         f"💸 Купили подписку: {paid_users}\n\n"
         f"✏️ Чтобы активировать подписку пользователю, напиши: /activate ID", parse_mode="HTML")
-    logger.info(f"Администратор {message.from_user.id} открыл админ-панель.")
+    logger.info("Администратор %s открыл админ-панель.", message.from_user.id)
+
+@dp.message(Command("economy"))
+async def cmd_economy(message: Message):
+    """Обработчик команды /economy (включает/выключает эконом-режим анализа фото)."""
+    user_id = message.from_user.id
+    await ensure_user(user_id)
+    try:
+        async with pool.write() as db:
+            await db.execute(SQL_TOGGLE_ECONOMY, (user_id,))
+            async with db.execute(SQL_GET_USE_STATE, (user_id,)) as cur:
+                row = await cur.fetchone()
+    except sqlite3.Error as e:
+        logger.error("Ошибка при переключении эконом-режима для пользователя %s: %s", user_id, e)
+        return await message.answer("❌ Не удалось переключить эконом-режим.")
+
+    economy = bool(row and row[1])
+    if economy:
+        await message.answer("🐢 Эконом-режим включен: фото обрабатываются пакетами, ответ приходит в течение 24 часов.")
+    else:
+        await message.answer("⚡️ Эконом-режим выключен: фото снова обрабатываются сразу.")
+    logger.info("Пользователь %s переключил эконом-режим: %s.", user_id, economy)
 
 @dp.message(Command("activate"))
 async def cmd_activate_user(message: Message):
@@ -341,28 +1153,29 @@ async def cmd_activate_user(message: Message):
     user_id_str = parts[1]
     try:
         user_id = int(user_id_str)
-        cursor.execute("UPDATE users SET uses_left = 999 WHERE user_id = ?", (user_id,))
-        conn.commit()
-        if cursor.rowcount > 0:
+        async with pool.write() as db:
+            cur = await db.execute(SQL_ACTIVATE, (user_id,))
+            updated = cur.rowcount
+        if updated > 0:
+            USES_CACHE[user_id] = 999
             await message.answer(f"✅ Подписка для пользователя {user_id} активирована.")
-            logger.info(f"Администратор {message.from_user.id} активировал подписку для {user_id}.")
+            logger.info("Администратор %s активировал подписку для %s.", message.from_user.id, user_id)
             try:
                 await bot.send_message(chat_id=user_id, text="🎉 Ваша подписка активирована! Теперь у вас неограниченный доступ.")
             except Exception as e:
-                logger.warning(f"Не удалось уведомить пользователя {user_id} об активации подписки: {e}")
+                logger.warning("Не удалось уведомить пользователя %s об активации подписки: %s", user_id, e)
         else:
             await message.answer(f"❌ Пользователь {user_id} не найден в базе данных.")
-            logger.warning(f"Администратор {message.from_user.id} попытался активировать подписку для несуществующего пользователя {user_id}.")
+            logger.warning("Администратор %s попытался активировать подписку для несуществующего пользователя %s.", message.from_user.id, user_id)
     except ValueError:
         await message.answer("❌ ID пользователя должен быть числом.")
-        logger.warning(f"Администратор {message.from_user.id} ввел некорректный ID для активации: {user_id_str}.")
+        logger.warning("Администратор %s ввел некорректный ID для активации: %s.", message.from_user.id, user_id_str)
     except sqlite3.Error as e:
-        logger.error(f"Ошибка при активации подписки для пользователя {user_id_str}: {e}")
+        logger.error("Ошибка при активации подписки для пользователя %s: %s", user_id_str, e)
         await message.answer("❌ Ошибка при активации подписки.")
 
-@dp.message(F.text == "💳 Оплата подписки")
 @dp.message(Command("buy"))
-async def cmd_buy(message: Message):
+async def cmd_buy(message: Message, state: FSMContext):
     """Обработчик команды /buy и кнопки 'Оплата подписки'."""
     caption = (
         "💳 Подписка стоит $2.5 через CryptoBot:\n\n"
@@ -371,106 +1184,77 @@ async def cmd_buy(message: Message):
         "Если вы оплатили, сообщите в <a href='https://t.me/calloritpay'>канал поддержки</a>."
     )
     await send_photo_or_text(message.chat.id, "pay.png", caption, parse_mode="HTML")
-    logger.info(f"Пользователь {message.from_user.id} запросил информацию об оплате.")
+    logger.debug("Пользователь %s запросил информацию об оплате.", message.from_user.id)
 
-@dp.message(F.text.in_(["🍱 Узнать калории по фото", "📸 Сделать фото"]))
 async def prompt_photo(message: Message, state: FSMContext):
     """Обработчик кнопок 'Узнать калории по фото' и 'Сделать фото'."""
     image_name = "photocall.png" if "Узнать" in message.text else "sendphoto.png"
     caption = "📸 Пожалуйста, отправьте фото блюда."
     await send_photo_or_text(message.chat.id, image_name, caption)
     await state.set_state(GenStates.await_photo)
-    logger.info(f"Пользователь {message.from_user.id} запросил отправку фото.")
+    logger.debug("Пользователь %s запросил отправку фото.", message.from_user.id)
 
 @dp.message(F.photo, GenStates.await_photo)
 async def handle_photo(message: Message, state: FSMContext):
-    """Обработчик полученной фотографии для определения калорийности и БЖУ."""
+    """
+    Обработчик полученной фотографии для определения калорийности и БЖУ.
+    Списывает использование и ставит фото в очередь; сам анализ выполняют воркеры (см. photo_worker).
+    """
     user_id = message.from_user.id
-    ensure_user(user_id)
+    await ensure_user(user_id)
 
-    cursor.execute("SELECT uses_left FROM users WHERE user_id = ?", (user_id,))
-    row = cursor.fetchone()
-    uses_left = row[0] if row else 0
+    # Списываем использование заранее одним атомарным запросом: OpenAI вызывается только после успешного списания
+    consumed = await consume_use(user_id)
 
-    if uses_left <= 0:
-        await message.answer("🔐 Лимит использований исчерпан. Оформите подписку для продолжения.")
-        logger.info(f"Пользователь {user_id} исчерпал лимит использований.")
+    if consumed is CONSUME_FAILED:
+        await message.answer("❌ Ошибка при обработке изображения. Попробуйте ещё раз позже.")
         await state.clear()
         return
 
-    # Отправляем сообщение о начале обработки
-    processing_message = await message.answer("⏳ Обрабатываю ваше фото, пожалуйста, подождите...")
+    if consumed is None:
+        await message.answer("🔐 Лимит использований исчерпан. Оформите подписку для продолжения.")
+        logger.info("Пользователь %s исчерпал лимит использований.", user_id)
+        await state.clear()
+        return
 
     try:
+        _, economy = consumed
+        # Отправляем сообщение о начале обработки — воркер заменит его текст результатом
+        if economy:
+            processing_message = await message.answer("🐢 Фото принято в эконом-режиме. Ответ придет сюда в течение 24 часов.")
+        else:
+            processing_message = await message.answer("⏳ Обрабатываю ваше фото, пожалуйста, подождите...")
         photo = message.photo[-1] # Берем фото наилучшего качества
-        file = await bot.get_file(photo.file_id)
-        file_path = file.file_path
-        file_data = await bot.download_file(file_path)
-        image_bytes = file_data.read()
-
-        # Вызываем OpenAI API для анализа изображения с запросом на БЖУ
-        response = await openai_client.chat.completions.create(
-            model="gpt-4o", # Используем модель gpt-4o для анализа изображений
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Что изображено на фото? Укажи примерную калорийность блюда, а также содержание белков, жиров и углеводов (БЖУ) в граммах. Отвечай только на русском языке."},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64.b64encode(image_bytes).decode()}"}}
-                    ]
-                }
-            ],
-            max_tokens=500 # Максимальное количество токенов в ответе
-        )
-        answer = response.choices[0].message.content
-
-        # Отправка результата пользователю
-        await message.answer(f"📊 Ответ:\n{answer}")
-        logger.info(f"Пользователь {user_id} получил ответ от OpenAI с калориями и БЖУ.")
-
-        # Отправка уведомления в канал (если CHANNEL_ID установлен)
-        if CHANNEL_ID:
-            username_or_id = f"@{message.from_user.username}" if message.from_user.username else f"ID: {user_id}"
-            try:
-                await bot.send_message(
-                    chat_id=CHANNEL_ID,
-                    text=f"📷 Пользователь {username_or_id} загрузил фото еды. Калории и БЖУ вычислены."
-                )
-                logger.info(f"Уведомление о фото от {user_id} отправлено в канал.")
-            except Exception as e:
-                logger.error(f"Не удалось отправить уведомление в канал {CHANNEL_ID}: {e}")
-
-        # Обновляем счётчик использований
-        cursor.execute("UPDATE users SET uses_left = uses_left - 1 WHERE user_id = ?", (user_id,))
-        conn.commit()
-        logger.info(f"Счетчик использований для пользователя {user_id} уменьшен. Осталось: {uses_left - 1}.")
-
+        await photo_queue.put(PhotoJob(
+            user_id=user_id,
+            chat_id=message.chat.id,
+            file_id=photo.file_id,
+            message_id=processing_message.message_id,
+            username=message.from_user.username,
+            economy=economy,
+        ))
+        logger.debug("Фото пользователя %s поставлено в очередь. В очереди: %s.", user_id, photo_queue.qsize())
     except Exception as e:
-        logger.exception(f"Ошибка при обработке изображения для пользователя {user_id}: {e}")
+        logger.exception("Ошибка при постановке фото в очередь для пользователя %s: %s", user_id, e)
+        await refund_use(user_id)
         await message.answer("❌ Ошибка при обработке изображения. Попробуйте ещё раз позже.")
     finally:
-        # Удаляем сообщение "Обрабатываю..."
-        try:
-            await bot.delete_message(chat_id=processing_message.chat.id, message_id=processing_message.message_id)
-        except Exception as e:
-            logger.warning(f"Не удалось удалить сообщение об обработке: {e}")
         await state.clear() # Очищаем состояние после обработки
 
-@dp.message(F.text == "📚 Как пользоваться?")
-async def cmd_help(message: Message):
+async def cmd_help(message: Message, state: FSMContext):
     """Обработчик кнопки 'Как пользоваться?'."""
     caption = (
         "ℹ️ <b>Как пользоваться ботом</b>\n\n"
         "1. Нажмите \"Узнать калории по фото\"\n"
         "2. Отправьте фото еды\n"
         "3. Получите приблизительную калорийность блюда и БЖУ.\n\n"
-        "🔁 Бесплатно доступно 10 использований. Подписка откроет неограниченный доступ."
+        "🔁 Бесплатно доступно 10 использований. Подписка откроет неограниченный доступ.\n"
+        "🐢 Команда /economy включает эконом-режим: фото обрабатываются пакетами, ответ приходит в течение 24 часов."
     )
     await send_photo_or_text(message.chat.id, "help.png", caption, parse_mode="HTML")
-    logger.info(f"Пользователь {message.from_user.id} запросил помощь.")
+    logger.debug("Пользователь %s запросил помощь.", message.from_user.id)
 
-@dp.message(F.text == "🏋️ Программы тренировок")
-async def send_training_programs(message: Message):
+async def send_training_programs(message: Message, state: FSMContext):
     """Обработчик кнопки 'Программы тренировок'."""
     caption = (
         "🏋️‍♀️ <b>Полезные программы:</b>\n\n"
@@ -478,12 +1262,11 @@ async def send_training_programs(message: Message):
         "- <a href='https://t.me/Itmarket1_bot?start=good_82170'>Спорт без инвентаря (курс)</a>"
     )
     await send_photo_or_text(message.chat.id, "programm.png", caption, parse_mode="HTML")
-    logger.info(f"Пользователь {message.from_user.id} запросил программы тренировок.")
+    logger.debug("Пользователь %s запросил программы тренировок.", message.from_user.id)
 
 # === НОВЫЙ ФУНКЦИОНАЛ: IQ ТЕСТ ===
-@dp.message(F.text == "🧠 IQ Тест")
 @dp.message(Command("iqtest"))
-async def cmd_iq_test(message: Message):
+async def cmd_iq_test(message: Message, state: FSMContext):
     """
     Обработчик для кнопки 'IQ Тест' и команды /iqtest.
     Отправляет пользователю картинку и ссылку на IQ-бота.
@@ -493,36 +1276,82 @@ async def cmd_iq_test(message: Message):
         "<a href='https://t.me/iqmanager1_bot'>🔗 Перейти к IQ-тесту</a>"
     )
     await send_photo_or_text(message.chat.id, "iq.png", caption, parse_mode="HTML")
-    logger.info(f"Пользователь {message.from_user.id} запросил IQ-тест.")
+    logger.debug("Пользователь %s запросил IQ-тест.", message.from_user.id)
+
+# === Кнопки меню и текстовые команды ===
+# Текст сообщения -> обработчик. Вместо отдельного фильтра F.text == "..." на каждую кнопку
+# регистрируется один фильтр, а нужный обработчик находится поиском по словарю.
+BUTTON_HANDLERS = {
+    "/start": cmd_start,
+    "/menu": cmd_start,
+    "/profile": cmd_profile,
+    "👤 Профиль": cmd_profile,
+    "/admin": cmd_admin,
+    "💳 Оплата подписки": cmd_buy,
+    "🍱 Узнать калории по фото": prompt_photo,
+    "📸 Сделать фото": prompt_photo,
+    "📚 Как пользоваться?": cmd_help,
+    "🏋️ Программы тренировок": send_training_programs,
+    "🧠 IQ Тест": cmd_iq_test,
+}
+
+@dp.message(F.text.in_(frozenset(BUTTON_HANDLERS)))
+async def dispatch_button(message: Message, state: FSMContext):
+    """Передает нажатие кнопки (или текстовую команду) соответствующему обработчику."""
+    await BUTTON_HANDLERS[message.text](message, state)
 
 # === Запуск через webhook (FastAPI) ===
+async def process_update(update: types.Update):
+    """Передает обновление диспетчеру aiogram (выполняется в фоне, после ответа Telegram)."""
+    try:
+        await dp.feed_update(bot, update)
+    except Exception as e:
+        logger.exception("Ошибка обработки обновления %s: %s", update.update_id, e)
+
+# Типы обновлений, для которых зарегистрированы обработчики (например, только "message").
+# Остальные (edited_message, channel_post и т.д.) отбрасываются до построения модели Update.
+HANDLED_UPDATE_TYPES = frozenset(dp.resolve_used_update_types())
+
 @app.post("/")
-async def telegram_webhook(req: Request):
+async def telegram_webhook(req: Request, background_tasks: BackgroundTasks):
     """
     Основная точка входа для вебхуков Telegram.
-    Принимает входящие обновления от Telegram и передает их диспетчеру aiogram.
+    Принимает входящие обновления от Telegram и сразу отвечает, а обработка обновления
+    диспетчером aiogram выполняется в фоне — Telegram не ждет, пока отработают обработчики.
     """
     try:
         body = await req.body()
-        update = types.Update.model_validate_json(body)
-        await dp.feed_update(bot, update)
+        raw = orjson.loads(body)
+        if HANDLED_UPDATE_TYPES.isdisjoint(raw):
+            return {"ok": True}
+        # Контекст с ботом обязателен: иначе feed_update увидит update.bot != bot и провалидирует Update заново
+        update = types.Update.model_validate(raw, context={"bot": bot})
+        background_tasks.add_task(process_update, update)
         return {"ok": True}
     except Exception as e:
-        logger.error(f"Ошибка обработки вебхука: {e}")
+        logger.error("Ошибка обработки вебхука: %s", e)
         return {"ok": False, "error": str(e)}, 500
 
 # === Альтернативный запуск через polling для локального теста ===
 # Этот блок кода будет выполняться только при прямом запуске файла (например, python main.py)
 # и не будет активен при развертывании через FastAPI/webhook.
 if __name__ == "__main__":
-    # Для локального polling-режима, чтобы init_db и setup_bot_commands тоже выполнялись
-    init_db()
-    asyncio.run(setup_bot_commands())
-    
     async def main():
         """Основная функция для запуска бота в режиме polling."""
+        # Для локального polling-режима, чтобы init_db и setup_bot_commands тоже выполнялись.
+        # Всё выполняется в одном event loop, так как соединения aiosqlite к нему привязаны.
+        await init_db()
+        await setup_bot_commands()
+        start_activity_flusher()
+        start_photo_workers()
         logger.info("Запуск бота в режиме polling...")
-        await dp.start_polling(bot) # Запускаем polling
+        try:
+            await dp.start_polling(bot) # Запускаем polling
+        finally:
+            await stop_photo_workers()
+            await stop_activity_flusher()
+            await pool.close()
+            await openai_http.aclose() # Сессию бота закрывает сам start_polling
         logger.info("Бот остановлен.")
 
     asyncio.run(main())